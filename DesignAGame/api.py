@@ -6,12 +6,15 @@ from google.appengine.ext import ndb
 
 from models import StringMessage, GameForm, NewGameForm, ScoreForms, \
         MakeMoveForm, GameForms, RankingForm, RankingForms, HistoryForm, \
-        HistoryMoveForm
-from models import User, Game, Score, Move
+        HistoryMoveForm, UserForms, CreateUserResultForm, \
+        CreateUserResultForms
+from models import User, Game, Score, Move, Username, USERNAME_TAKEN, \
+        CREATE_REJECTED
 
 USER_REQUEST = endpoints.ResourceContainer(
         username=messages.StringField(1, required=True),
         email=messages.StringField(2))
+CREATE_USERS_REQUEST = endpoints.ResourceContainer(UserForms)
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1))
@@ -24,6 +27,9 @@ HIGH_SCORE_REQUEST = endpoints.ResourceContainer(
 
 MEMCACHE_AVERAGE_MOVES = 'AVERAGE_MOVES'
 
+# Maximum number of users in a single create_users request
+MAX_CREATE_USERS = 1000
+
 
 @endpoints.api(name='games', version='v1')
 class ConcentrationGameApi(remote.Service):
@@ -54,6 +60,19 @@ class ConcentrationGameApi(remote.Service):
             raise endpoints.BadRequestException('Incorrect kind')
         return entity
 
+    def _validate_user(self, username, email):
+        """Returns why a user cannot be created, or None if it is valid"""
+        # Check that username and email lengths do not exceed maximum
+        # Without this, the endpoint will fail with a 500, which is not robust
+        error = Username.key_name_error(username)
+        if error is not None:
+            return error
+        if email is None:
+            return 'Email must be specified'
+        if len(email) > 500:
+            return 'Email exceeds max length'
+        return None
+
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=StringMessage,
                       path='user',
@@ -61,23 +80,68 @@ class ConcentrationGameApi(remote.Service):
                       http_method='POST')
     def create_user(self, request):
         """Create a user"""
-        # Check that username and email lengths do not exceed maximum
-        # Without this, the endpoint will fail with a 500, which is not robust
-        if len(request.username) > 500:
-            raise endpoints.BadRequestException('Username exceeds max length')
-        if request.email is None:
-            raise endpoints.BadRequestException('Email must be specified')
-        if len(request.email) > 500:
-            raise endpoints.BadRequestException('Email exceeds max length')
-
-        # Find if a user with this username is already registered
-        if User.query(User.username == request.username).get():
-            raise endpoints.ConflictException('Username is already taken!')
-
-        # Register the user
-        User(username=request.username, email=request.email).put()
+        error = self._validate_user(request.username, request.email)
+        if error is not None:
+            raise endpoints.BadRequestException(error)
+
+        # Register the user unless the username is already claimed
+        result, = User.create_multi([(request.username, request.email)])
+        if result == USERNAME_TAKEN:
+            raise endpoints.ConflictException(result)
+        if result == CREATE_REJECTED:
+            raise endpoints.BadRequestException(result)
+        if not isinstance(result, User):
+            raise endpoints.InternalServerErrorException(result)
         return StringMessage(message='User %s created!' % request.username)
 
+    @endpoints.method(request_message=CREATE_USERS_REQUEST,
+                      response_message=CreateUserResultForms,
+                      path='users',
+                      name='create_users',
+                      http_method='POST')
+    def create_users(self, request):
+        """
+        Create users in bulk. Returns whether each user was created, in the
+        order requested.
+
+        Invalid rows and repeats of a username earlier in the request are
+        rejected without touching the Datastore. The rest are registered
+        together by User.create_multi.
+        """
+        if len(request.items) > MAX_CREATE_USERS:
+            raise endpoints.BadRequestException(
+                    'Cannot create more than %d users at once'
+                    % MAX_CREATE_USERS)
+
+        statuses = [None] * len(request.items)
+        rows = []
+        row_indexes = []
+        requested = set()
+        for i, item in enumerate(request.items):
+            error = self._validate_user(item.username, item.email)
+            if error is None and item.username in requested:
+                error = 'Username is repeated in this request'
+            if error is not None:
+                statuses[i] = error
+                continue
+            requested.add(item.username)
+            rows.append((item.username, item.email))
+            row_indexes.append(i)
+
+        created = [False] * len(request.items)
+        for i, result in zip(row_indexes, User.create_multi(rows)):
+            if isinstance(result, User):
+                created[i] = True
+                statuses[i] = 'User %s created!' % result.username
+            else:
+                statuses[i] = result
+
+        return CreateUserResultForms(
+                items=[CreateUserResultForm(username=item.username,
+                                            created=created[i],
+                                            message=statuses[i])
+                       for i, item in enumerate(request.items)])
+
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
@@ -0,0 +1,243 @@
+"""
+Reports how many index rows each model writes per put and compares the
+indexed properties of each model with the queries the API actually issues.
+
+Run from this directory with the App Engine SDK installed:
+
+    python index_report.py [num_pairs]
+
+Nothing is written to the Datastore. Entities are serialized locally and their
+index rows counted the same way the Datastore builds them: one row in the kind
+index, an ascending and a descending row for every indexed value and one row
+per combination of values in each composite index from index.yaml.
+
+Queried properties are the properties in index.yaml plus those found by
+scanning the source for Model.property inside .query(), .filter() and
+.order() calls and names in projection lists. Filters or sort orders built
+elsewhere and passed in through a variable, and properties named by string
+anywhere else, are not found, so check any "indexed, not queried" property by
+hand before marking it unindexed.
+"""
+import itertools
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+os.environ.setdefault('APPLICATION_ID', 'dev~index-report')
+
+from google.appengine.api import datastore_index
+from google.appengine.ext import ndb
+
+from models import User, Game, Score, Move, Username
+
+MODELS = dict((model._get_kind(), model)
+              for model in (User, Game, Score, Username))
+
+# Source files that issue queries
+QUERY_SOURCES = ['api.py', 'main.py', 'models.py']
+
+QUERY_CALL = re.compile(r'(\w*)\.(query|filter|order)\(')
+PROPERTY_REF = re.compile(r'\b(\w+)\.(\w+)\b')
+PROJECTION = re.compile(r'projection=[\[(]([^\])]*)[\])]')
+QUOTED_NAME = re.compile(r'[\'"](\w+)[\'"]')
+
+
+def load_composite_indexes(filename='index.yaml'):
+    """Returns the composite index definitions in index.yaml"""
+    with open(filename) as index_file:
+        definitions = datastore_index.ParseIndexDefinitions(index_file)
+    if definitions is None or definitions.indexes is None:
+        return []
+    return definitions.indexes
+
+
+def _call_arguments(source, start):
+    """Returns the text between the opening parenthesis at start and its
+    matching closing parenthesis"""
+    depth = 1
+    end = start
+    while depth and end < len(source):
+        if source[end] == '(':
+            depth += 1
+        elif source[end] == ')':
+            depth -= 1
+        end += 1
+    return source[start:end - 1]
+
+
+def queried_properties(composite_indexes, filenames=QUERY_SOURCES):
+    """
+    Finds the properties of each model used in query filters, sort orders and
+    projections in the given source files, plus those in composite indexes.
+    """
+    queried = dict((kind, set()) for kind in MODELS)
+
+    for filename in filenames:
+        with open(filename) as source_file:
+            source = source_file.read()
+
+        for match in QUERY_CALL.finditer(source):
+            arguments = _call_arguments(source, match.end())
+            for kind, name in PROPERTY_REF.findall(arguments):
+                if kind in MODELS and name in MODELS[kind]._properties:
+                    queried[kind].add(name)
+
+            kind = match.group(1)
+            if match.group(2) == 'query' and kind in MODELS:
+                for projection in PROJECTION.findall(arguments):
+                    queried[kind].update(QUOTED_NAME.findall(projection))
+
+    for index in composite_indexes:
+        if index.kind in queried:
+            queried[index.kind].update(prop.name for prop in index.properties)
+
+    return queried
+
+
+def indexed_properties(model):
+    """Returns the names of the indexed properties of a model"""
+    names = set()
+    for name, prop in model._properties.iteritems():
+        if isinstance(prop, ndb.StructuredProperty):
+            if any(sub._indexed for sub in
+                   prop._modelclass._properties.itervalues()):
+                names.add(name)
+        elif prop._indexed:
+            names.add(name)
+    return names
+
+
+def index_rows(entity, composite_indexes):
+    """Returns the set of index rows the Datastore keeps for an entity"""
+    kind = entity._get_kind()
+    values = {}
+    for prop in entity._to_pb().property_list():
+        # Structured subproperties are serialized as e.g. history.card_1
+        name = prop.name().split('.')[0]
+        values.setdefault(name, []).append(
+            (prop.name(), prop.value().Encode()))
+
+    rows = set([('kind', kind)])
+    for name, name_values in values.iteritems():
+        for value in name_values:
+            rows.add(('asc', name, value))
+            rows.add(('desc', name, value))
+
+    for index in composite_indexes:
+        if index.kind != kind:
+            continue
+        names = tuple(prop.name for prop in index.properties)
+        if not all(name in values for name in names):
+            continue
+        for combination in itertools.product(*[values[n] for n in names]):
+            rows.add(('composite', names, combination))
+
+    return rows
+
+
+class RowCounter(object):
+    """Counts index rows written by successive puts of a single entity"""
+    def __init__(self, composite_indexes):
+        self.composite_indexes = composite_indexes
+        self.previous = set()
+        self.puts = []
+
+    def put(self, entity):
+        """Records a put of entity, returning the index rows it writes"""
+        rows = index_rows(entity, self.composite_indexes)
+        # Changed rows are deleted and unchanged rows are left untouched
+        written = len(rows ^ self.previous)
+        self.previous = rows
+        self.puts.append(written)
+        return written
+
+
+def simulate_game(num_pairs, composite_indexes):
+    """
+    Plays a game the way make_move does, missing once before every match, and
+    returns the index rows written by new_game and by each make_move put.
+    """
+    counter = RowCounter(composite_indexes)
+    user_key = ndb.Key('User', 1)
+
+    game = Game.new_game(user_key, num_pairs)
+    game.key = ndb.Key('Game', 1)
+    game.last_move = datetime.now()
+    counter.put(game)
+
+    positions = [[] for i in xrange(num_pairs)]
+    for index, value in enumerate(game.cards):
+        positions[value].append(index)
+
+    def choose(card):
+        if game.previous_choice is None:
+            game.previous_choice = card
+        else:
+            game.history.append(Move(card_1=game.previous_choice,
+                                     card_2=card))
+            if game.cards[game.previous_choice] == game.cards[card]:
+                game.uncovered_pairs.append(game.cards[card])
+                if game.num_uncovered_pairs == game.num_pairs:
+                    game.game_over = True
+                    game.end_time = game.last_move + timedelta(minutes=1)
+            game.previous_choice = None
+        game.last_move += timedelta(seconds=1)
+        game.email_sent = False
+        counter.put(game)
+
+    for value, (first, second) in enumerate(positions):
+        if value + 1 < num_pairs:
+            choose(first)
+            choose(positions[value + 1][0])
+        choose(first)
+        choose(second)
+
+    return counter.puts[0], counter.puts[1:]
+
+
+def main(num_pairs=8):
+    composite_indexes = load_composite_indexes()
+    queried = queried_properties(composite_indexes)
+
+    new_game_rows, move_rows = simulate_game(num_pairs, composite_indexes)
+
+    samples = {
+        'User': User(key=ndb.Key('User', 1), username='player',
+                     email='player@example.com'),
+        'Username': Username(id='player', user=ndb.Key('User', 1)),
+        'Score': Score(key=ndb.Key('Score', 1), user=ndb.Key('User', 1),
+                       datetime=datetime.now(), score=100, moves=16,
+                       time_used=60),
+    }
+
+    for kind in sorted(MODELS):
+        indexed = indexed_properties(MODELS[kind])
+        print kind
+        print '  indexed:               %s' % ', '.join(sorted(indexed))
+        print '  queried:               %s' % ', '.join(sorted(queried[kind]))
+        print '  indexed, not queried:  %s' \
+            % (', '.join(sorted(indexed - queried[kind])) or '(none)')
+        print '  queried, not indexed:  %s' \
+            % (', '.join(sorted(queried[kind] - indexed)) or '(none)')
+
+        if kind == 'Game':
+            print '  rows on new_game:      %d' % new_game_rows
+            print '  rows per make_move:    %.1f average, %d max ' \
+                '(%d pairs, %d puts)' \
+                % (float(sum(move_rows)) / len(move_rows), max(move_rows),
+                   num_pairs, len(move_rows))
+        else:
+            rows = index_rows(samples[kind], composite_indexes)
+            print '  rows on create:        %d' % len(rows)
+        print
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
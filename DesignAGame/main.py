@@ -1,8 +1,15 @@
+import logging
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from api import ConcentrationGameApi
 
-from models import User
+from models import User, Game, Score, Username, CompletedMigration, \
+    CLAIM_USERNAMES_MIGRATION
+
+# Number of entities rewritten by each reindex task
+REINDEX_BATCH_SIZE = 100
 
 
 class SendReminderEmail(webapp2.RequestHandler):
@@ -37,7 +44,111 @@ class CacheAverageMoves(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class ReindexEntities(webapp2.RequestHandler):
+    MODELS = dict((model._get_kind(), model) for model in (User, Game, Score))
+
+    def get(self):
+        """
+        Starts a migration that rewrites every User, Game and Score entity.
+        Visit once after deploying a change to which properties are indexed.
+        """
+        for kind in self.MODELS:
+            taskqueue.add(url='/tasks/reindex', params={'kind': kind})
+        self.response.write('Reindexing %s' % ', '.join(self.MODELS))
+
+    def post(self):
+        """
+        Rewrites a batch of entities of one kind and queues the next batch.
+
+        Index rows are only removed when an entity is written again, so
+        entities stored before a property was marked unindexed keep its old
+        rows (and keep updating them) until they are put with the new model.
+
+        Each entity is read and written again in its own transaction so a
+        concurrent make_move or end_game cannot be undone by the rewrite.
+        """
+        model = self.MODELS.get(self.request.get('kind'))
+        if model is None:
+            self.response.set_status(400)
+            return
+
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = model.query() \
+            .fetch_page(REINDEX_BATCH_SIZE, start_cursor=cursor,
+                        keys_only=True)
+
+        @ndb.transactional_tasklet
+        def rewrite(key):
+            entity = yield key.get_async()
+            if entity is not None:
+                yield entity.put_async()
+
+        # Raise on any failure so the task queue retries the whole batch
+        for future in [rewrite(key) for key in keys]:
+            future.get_result()
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/reindex',
+                          params={'kind': model._get_kind(),
+                                  'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class ClaimUsernames(webapp2.RequestHandler):
+    def get(self):
+        """
+        Starts claiming the usernames of users registered before usernames
+        were claimed. Visit once after deploying create_users.
+        """
+        taskqueue.add(url='/tasks/claim_usernames')
+        self.response.write('Claiming usernames')
+
+    def post(self):
+        """
+        Creates the missing Username entities for a batch of users and queues
+        the next batch. If several users share a username, the first one
+        found keeps it. Usernames that cannot be key names are logged and
+        skipped so they cannot stop the migration from finishing. After the
+        last batch, the migration is marked as completed so that creating
+        users no longer queries for existing ones.
+        """
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query() \
+            .fetch_page(REINDEX_BATCH_SIZE, start_cursor=cursor)
+
+        # Each claim is checked and written in a transaction so that it cannot
+        # overwrite a claim written by a concurrent create_user
+        @ndb.transactional_tasklet
+        def claim(username, user_key):
+            existing = yield Username.get_by_id_async(username)
+            if existing is None:
+                yield Username(id=username, user=user_key).put_async()
+
+        claims = {}
+        for user in users:
+            error = Username.key_name_error(user.username)
+            if error is not None:
+                logging.warning('Not claiming username of user %s: %s',
+                                user.key.id(), error)
+                continue
+            claims.setdefault(user.username, user.key)
+
+        # Raise on any failure so the task queue retries the whole batch
+        for future in [claim(username, user_key)
+                       for username, user_key in claims.iteritems()]:
+            future.get_result()
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/claim_usernames',
+                          params={'cursor': next_cursor.urlsafe()})
+        else:
+            CompletedMigration(id=CLAIM_USERNAMES_MIGRATION).put()
+        self.response.set_status(204)
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
     ('/tasks/cache_average_moves', CacheAverageMoves),
+    ('/tasks/reindex', ReindexEntities),
+    ('/tasks/claim_usernames', ClaimUsernames),
 ], debug=True)
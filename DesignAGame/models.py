@@ -1,26 +1,171 @@
 """This file contains the models and ProtoRPC messages used by the API"""
+import logging
 from protorpc import messages
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 import random
 from datetime import datetime
 from calendar import timegm
 
 
+# A user and its Username are in separate entity groups and a cross-group
+# transaction can use at most 25 groups
+USERS_PER_TRANSACTION = 12
+
+# Results of User.create_multi for rows that were not created
+USERNAME_TAKEN = 'Username is already taken!'
+CREATE_FAILED = 'Could not create user, try again'
+CREATE_REJECTED = 'Could not create user'
+
+# Errors after which creating the same users again may succeed
+TRANSIENT_ERRORS = (datastore_errors.TransactionFailedError,
+                    datastore_errors.Timeout,
+                    datastore_errors.InternalError)
+
+# Key names, and so usernames, are limited to 500 bytes of UTF-8
+MAX_KEY_NAME_BYTES = 500
+
+# Name of the migration that creates Username entities for existing users
+CLAIM_USERNAMES_MIGRATION = 'claim_usernames'
+
+
 class User(ndb.Model):
     """
     Object for implementing a single user.
     Authentication is not yet implemented
     """
     username = ndb.StringProperty(required=True)
-    email = ndb.StringProperty()
+    email = ndb.StringProperty(indexed=False)
     # Average of user's scores. Updated via task queue
     performance = ndb.FloatProperty(default=0.0)
 
+    @classmethod
+    def create_multi(cls, rows):
+        """
+        Registers users from a list of (username, email) pairs with distinct
+        usernames.
+
+        Taken usernames are found with one batched get of Username entities.
+        Until the claim_usernames migration has finished, usernames without a
+        Username are also checked against existing users with a query each.
+        The remaining users are inserted with put_multi in concurrent
+        cross-group transactions, each of which claims its usernames again
+        so that racing requests cannot register the same username twice.
+
+        Returns a list containing the new User for each row, USERNAME_TAKEN if
+        the username is already taken, CREATE_FAILED if its transaction failed
+        with a transient error or CREATE_REJECTED if the Datastore rejected
+        the row. A failed transaction does not affect the rows in other
+        transactions, and a transaction rejected by the Datastore is retried
+        one row at a time so that only the rejected rows fail.
+        """
+        claim_keys = [ndb.Key(Username, username) for username, email in rows]
+        migration_key = ndb.Key(CompletedMigration, CLAIM_USERNAMES_MIGRATION)
+        found = ndb.get_multi(claim_keys + [migration_key])
+        claims, migrated = found[:-1], found[-1] is not None
+        available = [i for i, claim in enumerate(claims) if claim is None]
+
+        if not migrated:
+            # Users registered before usernames were claimed have no Username
+            legacy = [cls.query(cls.username == rows[i][0])
+                      .get_async(keys_only=True) for i in available]
+            available = [i for i, future in zip(available, legacy)
+                         if future.get_result() is None]
+
+        results = [USERNAME_TAKEN] * len(rows)
+        if not available:
+            return results
+
+        first, last = cls.allocate_ids(len(available))
+        users = {}
+        for i, user_id in zip(available, xrange(first, last + 1)):
+            username, email = rows[i]
+            users[i] = cls(id=user_id, username=username, email=email)
+
+        @ndb.transactional_tasklet(xg=True)
+        def claim_usernames(indexes):
+            claims = yield ndb.get_multi_async([claim_keys[i]
+                                                for i in indexes])
+            created = [i for i, claim in zip(indexes, claims) if claim is None]
+            entities = []
+            for i in created:
+                entities.append(users[i])
+                entities.append(Username(key=claim_keys[i],
+                                         user=users[i].key))
+            yield ndb.put_multi_async(entities)
+            raise ndb.Return(created)
+
+        def run_transactions(groups):
+            """
+            Runs a transaction for each group concurrently, returning the
+            groups rejected by the Datastore
+            """
+            rejected = []
+            futures = [claim_usernames(group) for group in groups]
+            for group, future in zip(groups, futures):
+                try:
+                    created = future.get_result()
+                except datastore_errors.BadRequestError:
+                    rejected.append(group)
+                    continue
+                except TRANSIENT_ERRORS:
+                    logging.exception('Could not create users %s',
+                                      [rows[i][0] for i in group])
+                    for i in group:
+                        results[i] = CREATE_FAILED
+                    continue
+                for i in created:
+                    results[i] = users[i]
+            return rejected
+
+        rejected = run_transactions(
+                [available[i:i + USERS_PER_TRANSACTION]
+                 for i in xrange(0, len(available), USERS_PER_TRANSACTION)])
+        # Nothing in a rejected transaction was written, so retry each of its
+        # rows alone to find the rows that caused it
+        rejected = run_transactions([[i] for group in rejected for i in group])
+        for group in rejected:
+            for i in group:
+                logging.error('Datastore rejected user %r', rows[i][0])
+                results[i] = CREATE_REJECTED
+
+        return results
+
+
+class Username(ndb.Model):
+    """
+    Claims a username for a single user. Keyed by the username so that
+    uniqueness can be checked with keyed gets inside a transaction
+    """
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+
+    @staticmethod
+    def key_name_error(username):
+        """
+        Returns why a username cannot be used as the key name of a Username,
+        or None if it can
+        """
+        if not username:
+            return 'Username must be specified'
+        if isinstance(username, unicode):
+            username = username.encode('utf-8')
+        if len(username) > MAX_KEY_NAME_BYTES:
+            return 'Username exceeds max length'
+        # Key names beginning and ending with __ are reserved by the Datastore
+        if username.startswith('__') and username.endswith('__'):
+            return 'Username cannot begin and end with __'
+        return None
+
+
+class CompletedMigration(ndb.Model):
+    """Records that a data migration has finished. Keyed by its name"""
+    end_time = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
 
 class Move(ndb.Model):
     """A move, consisting of two cards. Stored as a structured property"""
-    card_1 = ndb.IntegerProperty(required=True)
-    card_2 = ndb.IntegerProperty(required=True)
+    card_1 = ndb.IntegerProperty(required=True, indexed=False)
+    card_2 = ndb.IntegerProperty(required=True, indexed=False)
 
 
 class Game(ndb.Model):
@@ -29,23 +174,26 @@ class Game(ndb.Model):
     uncovered_pairs = ndb.IntegerProperty(repeated=True, indexed=False)
     # the index of number first shown in a pair of numbers to check matches
     previous_choice = ndb.IntegerProperty(indexed=False)
-    attempts = ndb.IntegerProperty(default=0)
+    attempts = ndb.IntegerProperty(default=0, indexed=False)
     game_over = ndb.BooleanProperty(default=False)
-    start_time = ndb.DateTimeProperty(required=True)
-    end_time = ndb.DateTimeProperty()
+    start_time = ndb.DateTimeProperty(required=True, indexed=False)
+    end_time = ndb.DateTimeProperty(indexed=False)
+    # Move's subproperties are unindexed, so the history adds no index rows
     history = ndb.StructuredProperty(Move, repeated=True)
-    end_time = ndb.DateTimeProperty()
     user = ndb.KeyProperty(required=True, kind='User')
 
     # used to send reminder emails
     last_move = ndb.DateTimeProperty(auto_now_add=True)
     email_sent = ndb.BooleanProperty(default=False)
 
-    # Computed properties
+    # Computed properties. moves stays indexed for the projection query in
+    # _cache_average_moves
     moves = ndb.ComputedProperty(lambda self: len(self.history))
-    num_pairs = ndb.ComputedProperty(lambda self: len(self.cards) / 2)
+    num_pairs = ndb.ComputedProperty(lambda self: len(self.cards) / 2,
+                                     indexed=False)
     num_uncovered_pairs \
-        = ndb.ComputedProperty(lambda self: len(self.uncovered_pairs))
+        = ndb.ComputedProperty(lambda self: len(self.uncovered_pairs),
+                               indexed=False)
 
     # Only stored temporarily to track current move
     current_choice = None
@@ -237,11 +385,11 @@ class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
     # The time of finishing
-    datetime = ndb.DateTimeProperty(required=True)
-    moves = ndb.IntegerProperty(required=True)
+    datetime = ndb.DateTimeProperty(required=True, indexed=False)
+    moves = ndb.IntegerProperty(required=True, indexed=False)
     score = ndb.IntegerProperty(required=True)
     # The amount of time, in seconds, between starting and finishing
-    time_used = ndb.IntegerProperty(required=True)
+    time_used = ndb.IntegerProperty(required=True, indexed=False)
 
     def to_form(self):
         """Returns the ScoreForm representation of a score entry"""
@@ -272,6 +420,30 @@ class GameForm(messages.Message):
     message = messages.StringField(9, default='')
 
 
+class UserForm(messages.Message):
+    """Username and email of a user to create"""
+    username = messages.StringField(1, required=True)
+    # Checked per user so a missing email does not reject the whole request
+    email = messages.StringField(2)
+
+
+class UserForms(messages.Message):
+    """Multiple UserForms for creating users in bulk"""
+    items = messages.MessageField(UserForm, 1, repeated=True)
+
+
+class CreateUserResultForm(messages.Message):
+    """Whether a single user in a bulk request was created, and why not"""
+    username = messages.StringField(1, required=True)
+    created = messages.BooleanField(2, required=True)
+    message = messages.StringField(3, required=True)
+
+
+class CreateUserResultForms(messages.Message):
+    """Return multiple CreateUserResultForms, in the order requested"""
+    items = messages.MessageField(CreateUserResultForm, 1, repeated=True)
+
+
 class NewGameForm(messages.Message):
     """Create a new game"""
     username = messages.StringField(1, required=True)